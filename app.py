@@ -1,12 +1,18 @@
 import streamlit as st
-import pandas as pd
-from PyPDF2 import PdfReader
-from docx import Document
-import google.generativeai as genai
-from io import StringIO
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.runtime.uploaded_file_manager import UploadedFile
+import codecs
+import hashlib
+import xxhash
+import json
+import queue
+import re
+import threading
 import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import threading
+from string import Template
 
 # ==================== PAGE CONFIG ====================
 st.set_page_config(
@@ -17,7 +23,7 @@ st.set_page_config(
 )
 
 # ==================== CUSTOM CSS ====================
-st.markdown("""
+CUSTOM_CSS = """
     <style>
     .main {
         padding: 1rem;
@@ -54,11 +60,22 @@ st.markdown("""
         margin-bottom: 15px;
     }
     </style>
-""", unsafe_allow_html=True)
+"""
+
+# Re-emitted on every run on purpose: Streamlit drops any element a rerun does
+# not produce again, so injecting this only once per session would lose the styles.
+# Identical markdown is diffed away on the frontend and not re-rendered.
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 # ==================== SESSION STATE INITIALIZATION ====================
+# Gemini free-tier quotas as (requests, period in seconds), one token bucket each
+RATE_LIMITS = {
+    "minute": (15, 60),
+    "day": (1500, 24 * 60 * 60),
+}
+
 if "conversation_history" not in st.session_state:
-    st.session_state.conversation_history = {}
+    st.session_state.conversation_history = OrderedDict()
 if "current_context" not in st.session_state:
     st.session_state.current_context = ""
 if "current_file_name" not in st.session_state:
@@ -67,98 +84,308 @@ if "api_key" not in st.session_state:
     st.session_state.api_key = None
 if "generation_count" not in st.session_state:
     st.session_state.generation_count = 0
-if "last_request_time" not in st.session_state:
-    st.session_state.last_request_time = 0
+if "rate_buckets" not in st.session_state:
+    st.session_state.rate_buckets = {
+        name: {"tokens": capacity, "last_refill": time.time()}
+        for name, (capacity, _) in RATE_LIMITS.items()
+    }
 if "quota_reset_time" not in st.session_state:
     st.session_state.quota_reset_time = None
+if "extraction_job" not in st.session_state:
+    st.session_state.extraction_job = None
 
 # ==================== FILE PROCESSING FUNCTIONS ====================
-@st.cache_data(show_spinner=False)
-def read_pdf(pdf_file):
-    """Extract text from PDF with caching"""
-    try:
-        reader = PdfReader(pdf_file)
-        text = "\n".join([page.extract_text() or "" for page in reader.pages])
-        return text.strip()
-    except Exception as e:
-        st.error(f"Error reading PDF: {str(e)}")
-        return None
+# Parser and model libraries are imported inside the functions that use them,
+# so a rerun only pays for the modules the current upload actually needs.
 
-@st.cache_data(show_spinner=False)
-def read_docx(docx_file):
-    """Extract text from DOCX with caching"""
-    try:
-        doc = Document(docx_file)
-        text = "\n".join([p.text for p in doc.paragraphs])
-        for table in doc.tables:
-            for row in table.rows:
-                text += "\n" + " | ".join([cell.text for cell in row.cells])
-        return text.strip()
-    except Exception as e:
-        st.error(f"Error reading DOCX: {str(e)}")
-        return None
+# Prompts are cut to at most 20000 characters (PROMPT_TOKEN_BUDGET tokens at up to
+# 5 characters each). Parsing stops half again above that, leaving room for
+# whitespace normalization, so a document cut here still exceeds the prompt cut
+# and keeps its truncation marker
+EXTRACT_MAX_CHARS = 30000
 
-@st.cache_data(show_spinner=False)
-def read_txt(txt_file):
-    """Extract text from TXT with caching"""
-    try:
-        return StringIO(txt_file.getvalue().decode("utf-8")).read().strip()
-    except Exception as e:
-        st.error(f"Error reading TXT: {str(e)}")
-        return None
+def _hash_upload(uploaded_file):
+    """Stable cache key for an upload: name, size and an xxh3 digest of the full contents"""
+    return f"{uploaded_file.name}|{uploaded_file.size}|{xxhash.xxh3_128_hexdigest(uploaded_file.getvalue())}"
 
-@st.cache_data(show_spinner=False)
-def read_csv(csv_file):
-    """Extract text from CSV with caching"""
+@st.cache_resource
+def _pdfium_lock():
+    """Process-wide lock around PDFium, which is not thread-safe even across documents"""
+    return threading.Lock()
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def read_pdf(pdf_file, max_chars=EXTRACT_MAX_CHARS):
+    """Extract text from PDF with caching, stopping once max_chars is reached"""
+    import pypdfium2 as pdfium
+    parts = []
+    total = 0
+    # Every session runs its script on its own thread, so all PDFium calls,
+    # from opening the document to closing it, happen under the lock
+    with _pdfium_lock():
+        pdf = pdfium.PdfDocument(pdf_file.getvalue())
+        try:
+            # Pages are read one at a time; each page's handles are closed as
+            # soon as its text is out to keep native memory flat
+            for page in pdf:
+                textpage = page.get_textpage()
+                count = min(textpage.count_chars(), max_chars - total)
+                page_text = textpage.get_text_range(count=count)
+                textpage.close()
+                page.close()
+                parts.append(page_text)
+                total += len(page_text)
+                if total >= max_chars:
+                    break
+        finally:
+            # Free PDFium's native memory right away
+            pdf.close()
+    return "\n".join(parts).strip()
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def read_docx(docx_file, max_chars=EXTRACT_MAX_CHARS):
+    """Extract text from DOCX with caching, stopping once max_chars is reached"""
+    from docx import Document
+    from docx.oxml.ns import qn
+    doc = Document(docx_file)
+    # Walk the raw XML instead of building python-docx wrappers per paragraph
+    # and cell; this also keeps table text in document order
+    w_p, w_tbl, w_tr, w_tc = qn("w:p"), qn("w:tbl"), qn("w:tr"), qn("w:tc")
+    w_r, w_hyperlink, w_t, w_tab = qn("w:r"), qn("w:hyperlink"), qn("w:t"), qn("w:tab")
+    line_breaks = {qn("w:br"), qn("w:cr")}
+    
+    def paragraph_text(p):
+        # Direct runs only (as python-docx's Paragraph.text): text boxes nest
+        # whole paragraphs inside runs, stored twice for compatibility
+        pieces = []
+        for child in p:
+            if child.tag == w_r:
+                runs = (child,)
+            elif child.tag == w_hyperlink:
+                runs = child.iterchildren(w_r)
+            else:
+                continue
+            for run in runs:
+                for item in run:
+                    if item.tag == w_t:
+                        pieces.append(item.text or "")
+                    elif item.tag == w_tab:
+                        pieces.append("\t")
+                    elif item.tag in line_breaks:
+                        pieces.append("\n")
+        return "".join(pieces)
+    
+    parts = []
+    total = 0
+    for block in doc.element.body:
+        if block.tag == w_p:
+            lines = [paragraph_text(block)]
+        elif block.tag == w_tbl:
+            lines = [
+                " | ".join(
+                    "\n".join(paragraph_text(p) for p in cell.iterchildren(w_p))
+                    for cell in row.iterchildren(w_tc)
+                )
+                for row in block.iterchildren(w_tr)
+            ]
+        else:
+            continue
+        parts.extend(lines)
+        total += sum(len(line) + 1 for line in lines)
+        if total >= max_chars:
+            break
+    return "\n".join(parts).strip()
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def read_txt(txt_file, max_chars=EXTRACT_MAX_CHARS):
+    """Extract text from TXT with caching, up to max_chars"""
+    # UTF-8 needs at most 4 bytes per character, so only that prefix is decoded;
+    # the incremental decoder tolerates a character cut at the end of it
+    txt_file.seek(0)
+    head = txt_file.read(max_chars * 4)
+    text = codecs.getincrementaldecoder("utf-8")().decode(head, final=False)
+    return text[:max_chars].strip()
+
+def _frame_to_csv(df, max_chars, header=True, chunk_rows=500):
+    """Serialize a DataFrame to CSV in row chunks, stopping once max_chars is reached"""
+    if max_chars <= 0:
+        return ""
+    parts = []
+    total = 0
+    for start in range(0, max(len(df), 1), chunk_rows):
+        chunk = df.iloc[start:start + chunk_rows].to_csv(index=False, header=header and start == 0)
+        parts.append(chunk)
+        total += len(chunk)
+        if total >= max_chars:
+            break
+    return "".join(parts)[:max_chars]
+
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def read_csv(csv_file, max_chars=EXTRACT_MAX_CHARS):
+    """Extract text from CSV with caching, up to roughly max_chars"""
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    # Arrow's streaming reader parses in blocks; each block is serialized as it
+    # arrives and reading stops once the text fills the budget
     try:
-        df = pd.read_csv(csv_file)
-        return df.to_string()
-    except Exception as e:
-        st.error(f"Error reading CSV: {str(e)}")
-        return None
+        reader = pa_csv.open_csv(csv_file)
+        parts = []
+        total = 0
+        for batch in reader:
+            df = batch.to_pandas(types_mapper=pd.ArrowDtype)
+            chunk = _frame_to_csv(df, max_chars - total, header=not parts)
+            parts.append(chunk)
+            total += len(chunk)
+            if total >= max_chars:
+                break
+        if not parts:
+            # Header-only file: no batches, but keep the column names
+            parts.append(",".join(reader.schema.names) + "\n")
+        return "".join(parts)[:max_chars].strip()
+    except pa.ArrowInvalid:
+        # Column types are inferred from the first block; fall back to pandas
+        # when a later block disagrees with them
+        csv_file.seek(0)
+        # Each row renders to at least one character, so max_chars rows bounds the parse
+        df = pd.read_csv(csv_file, nrows=max_chars)
+        return _frame_to_csv(df, max_chars).strip()
 
-@st.cache_data(show_spinner=False)
-def read_excel(excel_file):
-    """Extract text from EXCEL with caching"""
+@st.cache_data(show_spinner=False, hash_funcs={UploadedFile: _hash_upload})
+def read_excel(excel_file, max_chars=EXTRACT_MAX_CHARS):
+    """Extract text from EXCEL with caching, stopping once max_chars is reached"""
+    import pandas as pd
+    # Open the workbook once with the Rust-based calamine reader
     try:
+        xls = pd.ExcelFile(excel_file, engine="calamine")
+    except (ImportError, ValueError):
+        # python-calamine not installed or pandas too old; pandas' openpyxl
+        # engine already opens workbooks in read-only mode
+        excel_file.seek(0)
         xls = pd.ExcelFile(excel_file)
-        text = ""
-        for sheet in xls.sheet_names:
-            df = pd.read_excel(excel_file, sheet_name=sheet)
-            text += f"\n--- Sheet: {sheet} ---\n" + df.to_string() + "\n"
-        return text.strip()
-    except Exception as e:
-        st.error(f"Error reading EXCEL: {str(e)}")
-        return None
+    parts = []
+    total = 0
+    for sheet in xls.sheet_names:
+        if total >= max_chars:
+            break
+        # Sheets are parsed one at a time so later ones are skipped once the budget is met
+        df = xls.parse(sheet, nrows=max_chars)
+        header = f"--- Sheet: {sheet} ---\n"
+        sheet_text = header + _frame_to_csv(df, max_chars - total - len(header))
+        parts.append(sheet_text)
+        total += len(sheet_text) + 1
+    return "\n".join(parts)[:max_chars].strip()
+
+# Runs of spaces/tabs collapse to one space, spaces around line breaks are dropped
+# (so whitespace-only lines become blank), and three or more line breaks collapse
+# to a single paragraph break
+_WS = re.compile(r"[ \t\f\v]+")
+_EOL = re.compile(r" ?\n ?")
+_NL = re.compile(r"\n{3,}")
+
+def normalize_whitespace(text):
+    """Squeeze redundant whitespace while keeping paragraph breaks"""
+    text = text.replace("\r\n", "\n").replace("\r", "\n")
+    text = _WS.sub(" ", text)
+    text = _EOL.sub("\n", text)
+    return _NL.sub("\n\n", text).strip()
 
 def extract_text(uploaded_file):
-    """Extract text from any supported file type"""
+    """Extract text from any supported file type, returning (text, error message)"""
     if uploaded_file is None:
-        return None
+        return None, None
     
     file_type = uploaded_file.name.split(".")[-1].lower()
     
     processors = {
-        "pdf": read_pdf,
-        "docx": read_docx,
-        "txt": read_txt,
-        "csv": read_csv,
-        "xls": read_excel,
-        "xlsx": read_excel
+        "pdf": (read_pdf, "PDF"),
+        "docx": (read_docx, "DOCX"),
+        "txt": (read_txt, "TXT"),
+        "csv": (read_csv, "CSV"),
+        "xls": (read_excel, "EXCEL"),
+        "xlsx": (read_excel, "EXCEL")
     }
     
-    processor = processors.get(file_type)
-    if processor:
-        return processor(uploaded_file)
-    else:
-        st.error(f"Unsupported file type: {file_type}")
-        return None
+    if file_type not in processors:
+        return None, f"Unsupported file type: {file_type}"
+    
+    # Runs on a worker thread, so errors are returned for the script thread to show
+    processor, label = processors[file_type]
+    try:
+        text = processor(uploaded_file, max_chars=EXTRACT_MAX_CHARS)
+    except Exception as e:
+        return None, f"Error reading {label}: {str(e)}"
+    return normalize_whitespace(text), None
+
+@st.cache_resource
+def _extraction_executor():
+    """Process-wide worker pool for document parsing (PDF jobs still serialize on _pdfium_lock)"""
+    return ThreadPoolExecutor(max_workers=2)
+
+def submit_extraction(uploaded_file):
+    """Run extract_text in the background, reusing this session's job for the same upload"""
+    upload_key = _hash_upload(uploaded_file)
+    job = st.session_state.extraction_job
+    if job is None or job[0] != upload_key:
+        if job is not None:
+            # A different file replaced the previous one; drop its job if it hasn't started
+            job[1].cancel()
+        job = (upload_key, _extraction_executor().submit(extract_text, uploaded_file))
+        st.session_state.extraction_job = job
+    return job[1]
 
 # ==================== MODEL CONFIGURATION ====================
+# Structured output schemas: compact keys keep the decoded JSON short
+MCQ_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "mcqs": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "q": {"type": "STRING"},
+                    "opts": {"type": "ARRAY", "items": {"type": "STRING"}},
+                    "ans": {"type": "STRING"},
+                },
+                "required": ["q", "opts", "ans"],
+            },
+        },
+    },
+    "required": ["mcqs"],
+}
+
+SHORT_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "shorts": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "q": {"type": "STRING"},
+                    "a": {"type": "STRING"},
+                },
+                "required": ["q", "a"],
+            },
+        },
+    },
+    "required": ["shorts"],
+}
+
 @st.cache_resource
+def _model_cache():
+    """Process-wide {api_key_hash: model} map (a module-level dict would be reset on every rerun)"""
+    return {}
+
 def get_generative_model(api_key):
     """Initialize and cache the generative AI model with fallback"""
+    api_key_hash = _api_key_hash(api_key)
+    models = _model_cache()
+    if api_key_hash in models:
+        return models[api_key_hash]
+    
     try:
+        import google.generativeai as genai
         genai.configure(api_key=api_key)
         model_options = ['gemini-2.0-flash', 'gemini-1.5-flash', 'gemini-1.5-pro']
         
@@ -170,8 +397,10 @@ def get_generative_model(api_key):
                         "You are an expert educational question generator. "
                         "Generate clear, concise, and well-structured questions that test understanding. "
                         "Avoid unnecessary explanations. Use proper punctuation and formatting."
-                    )
+                    ),
+                    generation_config={"response_mime_type": "application/json"}
                 )
+                models[api_key_hash] = model
                 return model
             except Exception:
                 continue
@@ -181,9 +410,93 @@ def get_generative_model(api_key):
         st.error(f"Model initialization error: {str(e)}")
         return None
 
+def _digest(text):
+    """Fast non-cryptographic digest of a large string, used in cache keys instead of the raw value"""
+    return xxhash.xxh3_64_hexdigest(text)
+
+def _api_key_hash(api_key):
+    """Cryptographic digest of the API key so the key itself never lands in a cache key"""
+    return hashlib.blake2b(api_key.encode(), digest_size=16).hexdigest()
+
+RESPONSE_TTL = 3600
+
+@st.cache_resource
+def _response_cache():
+    """Process-wide {(api_key_hash, prompt_key): (timestamp, items)} store of parsed Gemini responses"""
+    return {}
+
+def _parse_response(text, schema):
+    """Return the question list from a JSON response, raising if it is empty or malformed"""
+    field = schema["required"][0]
+    items = json.loads(text).get(field) if text.strip() else None
+    if not items:
+        raise ValueError("Gemini returned no questions; please try again")
+    return items
+
+def cached_responses(api_key_hash, requests):
+    """Return the cached question list for each (prompt, schema) request, or None where there is none"""
+    cache = _response_cache()
+    now = time.time()
+    for key, (saved_at, _) in list(cache.items()):
+        if now - saved_at >= RESPONSE_TTL:
+            cache.pop(key, None)
+    
+    return [cache.get((api_key_hash, _digest(prompt)), (None, None))[1] for prompt, _ in requests]
+
+def _call_gemini(api_key_hash, model, requests, results):
+    """Stream the requests whose entry in `results` is None from Gemini concurrently, filling them in"""
+    cache = _response_cache()
+    keys = [(api_key_hash, _digest(prompt)) for prompt, _ in requests]
+    pending = [i for i, items in enumerate(results) if items is None]
+    if not pending:
+        return results
+    
+    chunks = queue.Queue()
+    
+    def _gen(i):
+        prompt, schema = requests[i]
+        response = model.generate_content(prompt, generation_config={"response_schema": schema}, stream=True)
+        parts = []
+        for chunk in response:
+            parts.append(chunk.text)
+            chunks.put((i, chunk.text))
+        items = _parse_response("".join(parts), schema)
+        # Cache from the worker so a finished response is kept even if the run
+        # that asked for it was interrupted in the meantime
+        cache[keys[i]] = (time.time(), items)
+        return items
+    
+    streamed = {i: [] for i in pending}
+    with st.status("🧠 Receiving questions...", expanded=True) as status:
+        placeholders = {i: st.empty() for i in pending}
+        # The requests are network-bound, so threads overlap their latency
+        executor = ThreadPoolExecutor(max_workers=len(pending))
+        try:
+            futures = {i: executor.submit(_gen, i) for i in pending}
+            start_time = time.time()
+            while not all(future.done() for future in futures.values()) or not chunks.empty():
+                try:
+                    i, text = chunks.get(timeout=0.2)
+                except queue.Empty:
+                    # Still touch the page while waiting, so Streamlit can act on a
+                    # Stop or rerun request even before the first chunk arrives
+                    status.update(label=f"🧠 Receiving questions... {time.time() - start_time:.0f}s")
+                    continue
+                streamed[i].append(text)
+                placeholders[i].code("".join(streamed[i]), language="json")
+            for i, future in futures.items():
+                results[i] = future.result()  # Re-raises any request or parse error
+        finally:
+            # On interruption, don't block the rerun on the streams; they finish in
+            # the background and land in the cache
+            executor.shutdown(wait=False)
+        status.update(label="✅ Questions received", state="complete", expanded=False)
+    
+    return results
+
 # ==================== RATE LIMITING ====================
-def check_quota_limits():
-    """Check if user can make another request"""
+def check_quota_limits(cost=1):
+    """Check if user can make `cost` more requests and, if so, take them from the token buckets"""
     current_time = time.time()
     
     # Check if in quota reset period
@@ -195,59 +508,123 @@ def check_quota_limits():
     if st.session_state.quota_reset_time and current_time >= st.session_state.quota_reset_time:
         st.session_state.quota_reset_time = None
     
-    # Rate limit: 1 request per 3 seconds
-    if current_time - st.session_state.last_request_time < 3:
-        wait_time = 3 - (current_time - st.session_state.last_request_time)
-        return False, f"Wait {int(wait_time)}s before next request."
+    # Token buckets: refill each one for the time elapsed, then require `cost` tokens in all of them
+    buckets = st.session_state.rate_buckets
+    wait_time = 0
+    for name, (capacity, period) in RATE_LIMITS.items():
+        bucket = buckets[name]
+        rate = capacity / period
+        elapsed = current_time - bucket["last_refill"]
+        bucket["tokens"] = min(capacity, bucket["tokens"] + elapsed * rate)
+        bucket["last_refill"] = current_time
+        if bucket["tokens"] < cost:
+            wait_time = max(wait_time, (cost - bucket["tokens"]) / rate)
+    
+    if wait_time:
+        return False, f"Wait {int(wait_time) + 1}s before next request."
+    
+    for bucket in buckets.values():
+        bucket["tokens"] -= cost
     
     return True, None
 
 # ==================== QUESTION GENERATION ====================
+PROMPT_TOKEN_BUDGET = 4000
+# Upper end of the characters-per-token ratio, used to cut before counting
+MAX_CHARS_PER_TOKEN = 5
+
+@st.cache_data(show_spinner=False)
+def _count_tokens(api_key_hash, text_key, _model, _text):
+    """Token count of a text for the model, cached per API key and text digest"""
+    return _model.count_tokens(_text).total_tokens
+
+def truncate_to_tokens(api_key_hash, model, content, budget):
+    """Return the leading paragraphs of `content` that fit in `budget` tokens, and whether anything was cut"""
+    def count(text):
+        return _count_tokens(api_key_hash, _digest(text), model, text)
+    
+    # Cut on paragraph boundaries, or on lines for tabular text without blank lines
+    separator = "\n\n" if "\n\n" in content else "\n"
+    
+    def cut_at(text, limit):
+        end = text.rfind(separator, 0, limit)
+        return text[:end] if end > 0 else text[:limit]
+    
+    limit = budget * MAX_CHARS_PER_TOKEN
+    truncated = len(content) > limit
+    text = cut_at(content, limit) if truncated else content
+    
+    # Every shrink aims 5% under the budget and is counted again, so the result
+    # always fits; in practice this settles within a round or two
+    tokens = count(text)
+    while text and tokens > budget:
+        truncated = True
+        text = cut_at(text, int(len(text) * budget / tokens * 0.95))
+        tokens = count(text) if text else 0
+    return text, truncated
+
+# Prompt scaffolding lives here rather than in generate_questions; only the per-request values are filled in
+MCQ_PROMPT = Template("""Generate $count MCQs, each with exactly 4 options in opts and the correct letter (A/B/C/D) in ans.
+Difficulty: $difficulty
+Topic: $topic
+
+Content:
+$content""")
+
+SHORT_PROMPT = Template("""Generate $count short questions, each with a 2-3 line answer in a.
+Difficulty: $difficulty
+Topic: $topic
+
+Content:
+$content""")
+
+def format_questions(mcqs, shorts):
+    """Render structured MCQ and short-answer items as Markdown"""
+    lines = [f"### Multiple Choice ({len(mcqs)})"]
+    for i, item in enumerate(mcqs, 1):
+        options = [f"{letter}) {option}" for letter, option in zip("ABCD", item["opts"])]
+        lines.append("  \n".join([f"**Q{i}. {item['q']}**", *options, f"**Answer:** {item['ans']}"]))
+    
+    lines.append(f"### Short Answer ({len(shorts)})")
+    for i, item in enumerate(shorts, 1):
+        lines.append(f"**Q{i}. {item['q']}**  \n**Answer:** {item['a']}")
+    
+    return "\n\n".join(lines)
+
 def generate_questions(api_key, content, mcq_count, short_count, difficulty_level, topic_focus):
     """Generate MCQs and short questions with optimized prompt and rate limiting"""
     
-    # Check rate limits first
-    can_proceed, error_msg = check_quota_limits()
-    if not can_proceed:
-        st.warning(f"⏳ {error_msg}")
-        return None
-    
     try:
         model = get_generative_model(api_key)
         if model is None:
             return None
         
-        # Ultra-optimized content truncation
-        max_chars = 7000
-        truncated_content = content[:max_chars]
-        if len(content) > max_chars:
+        # Token-aware truncation on paragraph boundaries
+        truncated_content, truncated = truncate_to_tokens(
+            _api_key_hash(api_key), model, content, PROMPT_TOKEN_BUDGET
+        )
+        if truncated:
             truncated_content += "\n[Content truncated for optimization]"
         
-        # Minimal token prompt
-        prompt = f"""Generate {mcq_count} MCQs and {short_count} short questions.
-Difficulty: {difficulty_level}
-Topic: {topic_focus}
-
-Content:
-{truncated_content}
-
-=== MULTIPLE CHOICE ({mcq_count}) ===
-Q1. [Question]
-A) [Option A]
-B) [Option B]
-C) [Option C]
-D) [Option D]
-Answer: [A/B/C/D]
-
-=== SHORT ANSWER ({short_count}) ===
-Q1. [Question]
-Answer: [2-3 lines]"""
+        # Minimal token prompts, one per section so both can run at once
+        shared = {"difficulty": difficulty_level, "topic": topic_focus, "content": truncated_content}
+        mcq_prompt = MCQ_PROMPT.substitute(shared, count=mcq_count)
+        short_prompt = SHORT_PROMPT.substitute(shared, count=short_count)
+        
+        requests = ((mcq_prompt, MCQ_SCHEMA), (short_prompt, SHORT_SCHEMA))
+        api_key_hash = _api_key_hash(api_key)
+        results = cached_responses(api_key_hash, requests)
         
-        # Record request time
-        st.session_state.last_request_time = time.time()
+        # Rate limits only count the sections that actually need an API request
+        cost = results.count(None)
+        if cost:
+            can_proceed, error_msg = check_quota_limits(cost=cost)
+            if not can_proceed:
+                st.warning(f"⏳ {error_msg}")
+                return None
         
-        response = model.generate_content(prompt)
-        return response.text if response else None
+        mcqs, shorts = _call_gemini(api_key_hash, model, requests, results)
+        return format_questions(mcqs, shorts)
     
     except Exception as e:
         error_str = str(e)
@@ -273,6 +650,57 @@ Free tier has daily & hourly request limits. You've made many requests recently.
         st.error(f"❌ Error generating questions: {error_str[:200]}")
         return None
 
+# ==================== SAVED CONTEXTS ====================
+# Session state only keeps metadata; the text itself lives on disk so it doesn't
+# sit in every session's RAM. The index dies with the session, so entries are
+# scoped to it, deleted once nothing in it references them, and expire after
+# CONTEXT_TTL in case the session is simply abandoned.
+MAX_SAVED_CONTEXTS = 20
+VISIBLE_SAVED_CONTEXTS = 10
+CONTEXT_CACHE_DIR = "./.ctx_cache"
+CONTEXT_TTL = 24 * 60 * 60
+
+@st.cache_resource
+def _context_store():
+    """Process-wide on-disk store of saved context text"""
+    import diskcache
+    return diskcache.Cache(CONTEXT_CACHE_DIR)
+
+def _content_key(content):
+    """Context store key for this session's copy of `content`"""
+    session_id = get_script_run_ctx().session_id
+    return hashlib.blake2b(f"{session_id}\0{content}".encode(), digest_size=16).hexdigest()
+
+def release_context(content_key):
+    """Delete a stored context once no saved entry of this session refers to it"""
+    history = st.session_state.conversation_history
+    if not any(data["content_key"] == content_key for data in history.values()):
+        _context_store().delete(content_key)
+
+def render_saved_context(context_key, context_data):
+    """Render one saved context with its Load and Delete buttons"""
+    with st.expander(f"📄 {context_data['file']} - {context_data['timestamp']}"):
+        st.caption(f"Size: {context_data['size']}")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("✅ Load", key=f"load_{context_key}", use_container_width=True):
+                content = _context_store().get(context_data['content_key'])
+                if content is None:
+                    st.warning("⚠️ Saved content is no longer available")
+                else:
+                    st.session_state.current_context = content
+                    st.session_state.current_file_name = context_data['file']
+                    st.success("✅ Context loaded!")
+                    st.rerun()
+        
+        with col2:
+            if st.button("🗑️ Delete", key=f"del_{context_key}", use_container_width=True):
+                del st.session_state.conversation_history[context_key]
+                release_context(context_data['content_key'])
+                st.success("✅ Context deleted!")
+                st.rerun()
+
 # ==================== MAIN UI ====================
 # Header
 col1, col2 = st.columns([3, 1])
@@ -333,19 +761,33 @@ with st.sidebar:
         if st.button("💾 Save Context", use_container_width=True):
             if st.session_state.current_context.strip():
                 context_key = f"{st.session_state.current_file_name}_{datetime.now().strftime('%H:%M:%S')}"
-                st.session_state.conversation_history[context_key] = {
+                content_key = _content_key(st.session_state.current_context)
+                _context_store().set(content_key, st.session_state.current_context, expire=CONTEXT_TTL)
+                history = st.session_state.conversation_history
+                replaced = history.get(context_key)
+                history[context_key] = {
                     "file": st.session_state.current_file_name,
-                    "content": st.session_state.current_context,
+                    "content_key": content_key,
                     "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                     "size": f"{len(st.session_state.current_context)/1024:.1f} KB"
                 }
+                history.move_to_end(context_key)
+                if replaced:
+                    release_context(replaced["content_key"])
+                # Keep only the newest contexts
+                while len(history) > MAX_SAVED_CONTEXTS:
+                    _, evicted = history.popitem(last=False)
+                    release_context(evicted["content_key"])
                 st.success("✅ Context saved!")
             else:
                 st.warning("⚠️ No content to save")
     
     with col2:
         if st.button("🔄 Clear All", use_container_width=True):
-            st.session_state.conversation_history = {}
+            cleared = st.session_state.conversation_history
+            st.session_state.conversation_history = OrderedDict()
+            for context_data in cleared.values():
+                release_context(context_data["content_key"])
             st.session_state.current_context = ""
             st.success("✅ All contexts cleared!")
     
@@ -354,23 +796,19 @@ with st.sidebar:
         st.markdown("---")
         st.subheader("📚 Saved Contexts")
         
-        for context_key, context_data in st.session_state.conversation_history.items():
-            with st.expander(f"📄 {context_data['file']} - {context_data['timestamp']}"):
-                st.caption(f"Size: {context_data['size']}")
-                
-                col1, col2 = st.columns(2)
-                with col1:
-                    if st.button("✅ Load", key=f"load_{context_key}", use_container_width=True):
-                        st.session_state.current_context = context_data['content']
-                        st.session_state.current_file_name = context_data['file']
-                        st.success("✅ Context loaded!")
-                        st.rerun()
-                
-                with col2:
-                    if st.button("🗑️ Delete", key=f"del_{context_key}", use_container_width=True):
-                        del st.session_state.conversation_history[context_key]
-                        st.success("✅ Context deleted!")
-                        st.rerun()
+        # Newest first; older ones are only rendered on request
+        saved = list(reversed(st.session_state.conversation_history.items()))
+        for context_key, context_data in saved[:VISIBLE_SAVED_CONTEXTS]:
+            render_saved_context(context_key, context_data)
+        
+        older = saved[VISIBLE_SAVED_CONTEXTS:]
+        # A checkbox rather than an expander, since expanders cannot be nested
+        if older:
+            st.caption(f"{len(older)} older saved contexts")
+        # Fixed label and key, so saving or deleting doesn't reset the checkbox
+        if older and st.checkbox("Show older", key="show_older_contexts"):
+            for context_key, context_data in older:
+                render_saved_context(context_key, context_data)
 
 # ==================== MAIN CONTENT ====================
 if not st.session_state.api_key:
@@ -400,34 +838,48 @@ else:
         )
     
     if uploaded_file:
-        with st.spinner("📖 Processing document..."):
-            text_content = extract_text(uploaded_file)
+        future = submit_extraction(uploaded_file)
+        if not future.done():
+            # Poll instead of blocking: each status update gives Streamlit a chance to
+            # handle widget changes, and an interrupted run picks the same job up again
+            with st.status("📖 Processing document...") as status:
+                start_time = time.time()
+                while not future.done():
+                    time.sleep(0.2)
+                    status.update(label=f"📖 Processing document... {time.time() - start_time:.0f}s")
+                status.update(label="📖 Document processed", state="complete")
+        
+        text_content, extract_error = future.result()
+        
+        if text_content:
+            st.session_state.current_context = text_content
+            st.session_state.current_file_name = uploaded_file.name
             
-            if text_content:
-                st.session_state.current_context = text_content
-                st.session_state.current_file_name = uploaded_file.name
-                
-                # Show processing info
-                st.markdown(f"""
-                <div class="success-box">
-                <strong>✅ File Processed</strong><br>
-                📄 File: <strong>{uploaded_file.name}</strong><br>
-                📊 Size: <strong>{len(text_content)/1024:.1f} KB</strong> ({len(text_content)} characters)
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Preview
-                with st.expander("👁️ Preview Content", expanded=False):
-                    preview_length = min(2000, len(text_content))
-                    st.text_area(
-                        "Content Preview",
-                        text_content[:preview_length],
-                        height=200,
-                        disabled=True,
-                        label_visibility="collapsed"
-                    )
-                    if len(text_content) > preview_length:
-                        st.caption(f"... ({len(text_content) - preview_length} more characters)")
+            # Show processing info
+            st.markdown(f"""
+            <div class="success-box">
+            <strong>✅ File Processed</strong><br>
+            📄 File: <strong>{uploaded_file.name}</strong><br>
+            📊 Size: <strong>{len(text_content)/1024:.1f} KB</strong> ({len(text_content)} characters)
+            </div>
+            """, unsafe_allow_html=True)
+            
+            # Preview
+            with st.expander("👁️ Preview Content", expanded=False):
+                preview_length = min(2000, len(text_content))
+                st.text_area(
+                    "Content Preview",
+                    text_content[:preview_length],
+                    height=200,
+                    disabled=True,
+                    label_visibility="collapsed"
+                )
+                if len(text_content) > preview_length:
+                    st.caption(f"... ({len(text_content) - preview_length} more characters)")
+        else:
+            # Reported from the script thread, so it shows on every rerun
+            message = extract_error or f"No text could be extracted from {uploaded_file.name}"
+            st.error(f"❌ {message}")
     
     st.markdown("---")
     